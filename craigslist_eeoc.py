@@ -1,12 +1,17 @@
+import asyncio
 import csv
 import datetime
-import hashlib
 import logging
 import os.path
-import requests
-import time
-
-from bs4 import BeautifulSoup
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import httpx
+import xxhash
+import zstandard
+from ahocorasick import Automaton
+from bs4 import BeautifulSoup, SoupStrainer
 from craigslist import CraigslistJobs
 
 """
@@ -54,6 +59,39 @@ IL_CL_SITES = [
     "carbondale", "springfieldil", "stlouis", "quincy"
 ]
 
+# Prefix for cached post filenames. Bump this whenever the way we hash URLs (or store posts)
+# changes, so that old cache files are ignored rather than misread.
+CACHE_KEY_VERSION = 'v2'
+
+# Only build the tree for the posting body when parsing a post, we don't care about the rest of
+# the page
+POSTING_BODY_STRAINER = SoupStrainer('section', attrs={'id': 'postingbody'})
+
+# Cached posts are stored zstd-compressed, HTML shrinks a lot and decompresses very quickly
+CACHE_COMPRESSOR = zstandard.ZstdCompressor(level=3)
+CACHE_DECOMPRESSOR = zstandard.ZstdDecompressor()
+
+# How many posts to request from a single Craigslist site at once
+MAX_CONCURRENT_REQUESTS = 8
+
+# How many Craigslist sites to crawl at once, each in its own process
+MAX_CONCURRENT_SITES = 8
+
+# Per-request timeout, and how many times to try a request (backing off exponentially between
+# tries) before giving up on that post. Connection errors, timeouts, 5xx responses and the
+# statuses in RETRYABLE_STATUS_CODES are retried (Craigslist answers a client that's going too
+# fast with a 403 "blocked" page). Only 2xx responses, and the 404/410 that deleted or expired
+# posts return, get cached; anything else is given up on without caching it.
+REQUEST_TIMEOUT_SECONDS = 15
+RETRYABLE_STATUS_CODES = {403, 429}
+GONE_STATUS_CODES = {404, 410}
+MAX_REQUEST_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 0.3
+
+# Columns of the output CSV, in order. The first few are the keys of
+# `FlaggedPost.to_dict_for_csv`.
+FLAGGED_POST_CSV_COLUMNS = ['url', 'job_name', 'job_body', 'post_time', 'flagged_terms', 'time_accessed']
+
 class FlaggedPost(object):
     def __init__(self, url, job_name, job_body, post_time, flagged_terms, flagged_section_indices):
         self.url = url
@@ -88,91 +126,210 @@ class FlaggedPost(object):
         }
 
 def write_cl_post_to_file(path, content):
-    with open(path, 'w') as f:
-        f.write(str(content))
+    if not isinstance(content, bytes):
+        content = content.encode()
+
+    # Write to a temp file in the same directory and then move it into place, so that a crawl
+    # killed partway through a write never leaves a truncated file at `path`
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(CACHE_COMPRESSOR.compress(content))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 
 def read_cl_post_from_file(path):
-    with open(path, 'r') as f:
-        content = f.read()
+    """
+    Returns None if the cached file is corrupt (e.g. empty or truncated)
+    """
+    with open(path, 'rb') as f:
+        try:
+            content = CACHE_DECOMPRESSOR.decompress(f.read())
+        except zstandard.ZstdError as e:
+            logger.info('Could not decompress cached path {}: {}'.format(path, str(e)))
+            return None
 
     return content
 
 
-def process_posting(post, dubious_terms, local_base_path, ignore_cache=False, verbose=False):
+def build_term_automaton(terms):
+    """
+    Build an Aho-Corasick automaton out of `terms`, so that a post body can be checked for every
+    term in a single pass rather than one `find` per term.
     """
+    automaton = Automaton()
+    for term in terms:
+        automaton.add_word(term, term)
+    automaton.make_automaton()
+
+    return automaton
+
+# Built once at import time (every term is already lowercase), rather than per run or per post
+SEARCH_TERM_AUTOMATON = build_term_automaton(SEARCH_TERMS)
+
+
+def _cache_filename_for_url(post_url):
+    # hash the URL, save to a file based on that hash
+    hashed_url = '{}_{}'.format(CACHE_KEY_VERSION, xxhash.xxh64_hexdigest(post_url.encode()))
+    return '{}.zst'.format(hashed_url)
+
+
+def _scan_cache_dir(local_base_path):
+    """
+    Return the set of filenames already in the cache directory, so that checking whether a post is
+    cached is a set lookup rather than a stat() call per post
+    """
+    with os.scandir(local_base_path) as entries:
+        return {entry.name for entry in entries}
+
+
+async def fetch_raw(client, post_url, local_base_path, cache_index, ignore_cache=False):
+    """
+    :param: `client` is an httpx.AsyncClient to make the request with
+    :param: `post_url` is the URL of the Craigslist post
+    :param: `local_base_path` is the directory to save the webpage to
+    :param: `cache_index` is the set of filenames in `local_base_path` (see `_scan_cache_dir`), it's
+    updated when a newly fetched post is saved
+
+    Returns None if the post couldn't be fetched.
+    """
+    cache_filename = _cache_filename_for_url(post_url)
+    cached_path = '{}/{}'.format(local_base_path, cache_filename)
+
+    # check if file exists already, if it does, don't re-request it, just read it from disk
+    if cache_filename in cache_index and not ignore_cache:
+        logger.info('Reading from cached path {}'.format(cached_path))
+        raw_content = read_cl_post_from_file(cached_path)
+        # A corrupt cache file is treated as a cache miss, and gets overwritten below
+        if raw_content is not None:
+            return raw_content
+
+    logger.info('Not found locally, requesting from {}'.format(post_url))
+    for attempt in range(1, MAX_REQUEST_ATTEMPTS + 1):
+        try:
+            resp = await client.get(post_url)
+        except httpx.RequestError as e:
+            failure = str(e)
+        else:
+            if resp.is_success or resp.status_code in GONE_STATUS_CODES:
+                break
+            failure = 'status {}'.format(resp.status_code)
+            if resp.status_code < 500 and resp.status_code not in RETRYABLE_STATUS_CODES:
+                logger.warning('Giving up on {}: {}'.format(post_url, failure))
+                return None
+
+        logger.info('Request {} of {} for {} failed: {}'.format(
+            attempt, MAX_REQUEST_ATTEMPTS, post_url, failure)
+        )
+        if attempt == MAX_REQUEST_ATTEMPTS:
+            logger.warning('Giving up on {} after {} tries: {}'.format(
+                post_url, MAX_REQUEST_ATTEMPTS, failure)
+            )
+            return None
+        await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+    raw_content = resp.content
+    write_cl_post_to_file(cached_path, raw_content)
+    cache_index.add(cache_filename)
+
+    return raw_content
+
+
+def parse_and_flag(raw_content, post, dubious_terms):
+    """
+    :param: `raw_content` is the HTML of the post, either fetched or read from the local cache (or
+    None if it couldn't be fetched)
     :param: `post` is a dict, one of the dicts returned from calling `get_results` on a
     CraigslistJobs object
-    :param: `dubious_terms` is a set of terms that are "dubious" in that they often discriminate
-    against people with criminal records. Posts that include these terms will be "flagged" for
-    review.
-    :param: local_path is a path to save the webpage to
+    :param: `dubious_terms` is an automaton (see `build_term_automaton`) of terms that are
+    "dubious" in that they often discriminate against people with criminal records. Posts that
+    include these terms will be "flagged" for review.
     """
     job_name = post['name']
     post_url = post['url']
     post_time = post['datetime']
 
+    if raw_content is None:
+        return None
 
-    # check if file exists already, if it does, don't re-request it, just read it from disk
-    # hash the URL, save to a file based on that hash
-    hashed_url = hashlib.md5(post_url.encode()).hexdigest()
-    cached_path = '{}/{}'.format(local_base_path, hashed_url)
-    if os.path.isfile(cached_path) and not ignore_cache:
-        logger.info('Reading from cached path {}'.format(cached_path))
-        raw_content = read_cl_post_from_file(cached_path)
-    else:
-        logger.info('Not found locally, requesting from {}'.format(post_url))
-        resp = requests.get(post_url)
-        raw_content = resp.content
-        write_cl_post_to_file(cached_path, raw_content)
-
-    # Whether we got it from the interwebs or locally, parse `raw_content` now
-    soup = BeautifulSoup(raw_content, 'html.parser')
-    content = soup.find('section', {'id': 'postingbody'})
+    soup = BeautifulSoup(raw_content, 'lxml', parse_only=POSTING_BODY_STRAINER)
+    content = soup.find('section')
 
     if content is None:
-        if verbose:
-            print('Hm, no content for {}'.format(post_url))
+        logger.warning('Hm, no posting body for {}'.format(post_url))
         return None
 
     flagged_terms = []
     flagged_indices = []
 
-    body_text = content.text.lower()
-    for term in dubious_terms:
-        starting_index = body_text.find(term)
-        if starting_index != -1:
+    # Pull the text out of the tree and lowercase it once, everything below reuses it
+    body_text = content.get_text().lower()
+    for end_index, term in dubious_terms.iter(body_text):
+        # Only keep the first occurrence of each term
+        if term not in flagged_terms:
             flagged_terms.append(term)
-            flagged_indices.append(starting_index)
+            flagged_indices.append(end_index - len(term) + 1)
 
     if len(flagged_terms) > 0:
         return FlaggedPost(post_url, job_name, body_text, post_time, flagged_terms, flagged_indices)
     
     print('did not find anything dubious in {}'.format(post_url))
-    print(content.text.lower())
+    print(body_text)
 
     return None
 
-def write_posts_with_metadata(csv_path, post_objs):
-    datetime_accessed = datetime.datetime.now()
-    # don't write out the same posts more than once
-    post_urls_written = set()
-    column_names = list(post_objs[0].to_dict_for_csv().keys()) + ['time_accessed']
+async def process_site_postings(posts, dubious_terms, local_base_path, ignore_cache=False):
+    """
+    Fetch all of `posts` concurrently (at most MAX_CONCURRENT_REQUESTS in flight at a time), parse
+    each one as soon as it's fetched, and return the list of FlaggedPosts, one entry per post (None
+    if the post was not flagged).
+    """
+    os.makedirs(local_base_path, exist_ok=True)
+    cache_index = _scan_cache_dir(local_base_path)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    # One client for the whole site. Over HTTP/2 the concurrent requests are multiplexed over a
+    # single connection rather than each needing its own socket and TLS handshake.
+    limits = httpx.Limits(
+        max_connections=MAX_CONCURRENT_REQUESTS, max_keepalive_connections=MAX_CONCURRENT_REQUESTS
+    )
 
-    with open(csv_path, 'w') as f:
-        writer = csv.DictWriter(f, column_names)
-        writer.writeheader()
-        for post in post_objs:
-            post_url = post.url
-            if post_url not in post_urls_written:
-                to_write = {'time_accessed': str(datetime_accessed)}
-                to_write.update(post.to_dict_for_csv())
-                writer.writerow(to_write)
-                post_urls_written.add(post_url)
-            else:
-                logger.info('Skipping {} because already wrote it'.format(post_url))
-
-    print('Done writing {} posts to {}'.format(len(post_urls_written), csv_path))
+    async with httpx.AsyncClient(
+        http2=True, limits=limits, timeout=REQUEST_TIMEOUT_SECONDS, follow_redirects=True
+    ) as client:
+        async def bounded_fetch(post):
+            async with semaphore:
+                raw_content = await fetch_raw(
+                    client, post['url'], local_base_path, cache_index, ignore_cache=ignore_cache
+                )
+            # Whether we got it from the interwebs or locally, parse it right away so we only ever
+            # hold on to the flagged posts, not every page's HTML
+            return parse_and_flag(raw_content, post, dubious_terms)
+
+        return await asyncio.gather(*[bounded_fetch(post) for post in posts])
+
+
+def write_flagged_posts(writer, posts, post_urls_written):
+    """
+    Write each of `posts` to the CSV `writer`, skipping any whose URL is already in
+    `post_urls_written` (or repeated within `posts`). `post_urls_written` is updated in place.
+    """
+    # Dedupe up front, so we only build rows for posts we're actually going to write
+    posts_to_write = {}
+    for post in posts:
+        if post.url in post_urls_written or post.url in posts_to_write:
+            logger.info('Skipping {} because already wrote it'.format(post.url))
+            continue
+        posts_to_write[post.url] = post
+
+    time_accessed = str(datetime.datetime.now())
+    writer.writerows(
+        dict(post.to_dict_for_csv(), time_accessed=time_accessed)
+        for post in posts_to_write.values()
+    )
+    post_urls_written.update(posts_to_write)
 
 def _build_query_from_list_of_terms(terms):
     quoted_terms = []
@@ -187,14 +344,37 @@ def _build_query_from_list_of_terms(terms):
     return '|'.join(quoted_terms)
 
 
+def crawl_site(site, query, max_posts, ignore_cache=False):
+    """
+    Search one Craigslist `site` for `query`, fetch and check each of the (up to `max_posts`)
+    results, and return the list of FlaggedPosts. Runs in a worker process, see `main`.
+    """
+    cl_jobs = CraigslistJobs(
+        site=site,
+        filters={
+            'query': query
+        }
+    )
+
+    jobs = list(cl_jobs.get_results(limit=max_posts, sort_by='newest'))
+    num_processed = len(jobs)
+    print('Processing {} posts from {}'.format(num_processed, site))
+
+    processed = asyncio.run(
+        process_site_postings(jobs, SEARCH_TERM_AUTOMATON, 'cl_posts', ignore_cache=ignore_cache)
+    )
+    dubious_posts = [post for post in processed if post is not None]
+
+    print('{} --- {} of {} posts were flagged as dubious'.format(site, len(dubious_posts), num_processed))
+    return dubious_posts
+
+
 def main():
     # Config stuff
     max_posts = 2000
-    sleep_time_between_cities = 10
     ignore_cache = False
 
 
-    all_flagged_posts = []
     one_term = _build_query_from_list_of_terms(SEARCH_TERMS)
     time_started = datetime.datetime.now()
 
@@ -205,33 +385,24 @@ def main():
     logger.info('Search query is {}'.format(one_term))
     logger.info('Will write output to {}'.format(outfile_name))
 
-    for site in CALIFORNIA_CL_SITES:
-        cl_jobs = CraigslistJobs(
-            site=site,
-            filters={
-                'query': one_term
-            }
-        )
-
-        dubious_posts = []
-
-        num_processed = 0
-        for job in cl_jobs.get_results(limit=max_posts, sort_by='newest'):
-            potentially_dubious = process_posting(
-                job, SEARCH_TERMS, 'cl_posts', ignore_cache=ignore_cache
-            )
-            if potentially_dubious is not None:
-                dubious_posts.append(potentially_dubious)
+    # don't write out the same posts more than once
+    post_urls_written = set()
 
-            num_processed += 1
-            if num_processed % 100 == 0:
-                print('Done processing {}'.format(num_processed))
+    # Write each flagged post as soon as we have it, so a crash partway through a long crawl
+    # doesn't lose everything found so far
+    with open(outfile_name, 'w') as f:
+        writer = csv.DictWriter(f, FLAGGED_POST_CSV_COLUMNS)
+        writer.writeheader()
 
-        print('{} --- {} of {} posts were flagged as dubious'.format(site, len(dubious_posts), num_processed))
-        all_flagged_posts.extend(dubious_posts)
-        time.sleep(sleep_time_between_cities)
+        # Sites are independent of each other, so crawl them in parallel. `map` hands back each
+        # site's results in order, so we still write them out as they come in.
+        crawl = partial(crawl_site, query=one_term, max_posts=max_posts, ignore_cache=ignore_cache)
+        with ProcessPoolExecutor(max_workers=MAX_CONCURRENT_SITES) as executor:
+            for dubious_posts in executor.map(crawl, CALIFORNIA_CL_SITES):
+                write_flagged_posts(writer, dubious_posts, post_urls_written)
+                f.flush()
 
-    write_posts_with_metadata(outfile_name, all_flagged_posts)
+    print('Done writing {} posts to {}'.format(len(post_urls_written), outfile_name))
 
 if __name__ == '__main__':
     main()
@@ -1,13 +1,13 @@
-import collections
 import csv
 import datetime
-import hashlib
 import logging
+import operator
 import time
 
 import requests
-from bs4 import BeautifulSoup
+import xxhash
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -69,7 +69,31 @@ JOB_POST_FIELD_NAMES = [
 
 JOB_POST_FIELD_NAMES_WITH_ID = ['job_id'] + JOB_POST_FIELD_NAMES
 
-class JobPost(collections.namedtuple('JobPost', JOB_POST_FIELD_NAMES)):
+# Pulls the fields we want out of each job card (a div.job_content WebElement) in the browser, so
+# that all of them come back in a single round trip
+EXTRACT_JOB_FIELDS_JS = """
+return Array.from(arguments[0]).map(el => ({
+    title: el.querySelector('span.just_job_title')?.textContent,
+    org: el.querySelector('a.t_org_link')?.textContent,
+    snippet: el.querySelector('p.job_snippet')?.textContent,
+    href: el.querySelector('a.job_link')?.getAttribute('href'),
+}));
+"""
+
+class JobPost(object):
+    __slots__ = tuple(JOB_POST_FIELD_NAMES) + ('_job_id',)
+
+    def __init__(self, job_title, job_organization_name, job_snippet_text, source_url,
+                 job_search_term, location_search_term, full_url):
+        self.job_title = job_title
+        self.job_organization_name = job_organization_name
+        self.job_snippet_text = job_snippet_text
+        self.source_url = source_url
+        self.job_search_term = job_search_term
+        self.location_search_term = location_search_term
+        self.full_url = full_url
+        self._job_id = None
+
     def generate_job_id(self):
         """
         We'll define a job as being "unique" based on its:
@@ -79,17 +103,22 @@ class JobPost(collections.namedtuple('JobPost', JOB_POST_FIELD_NAMES)):
 
         So if a job like "Customer Serv Agent" from "Southwest Airlines Co." in "new+york" would be
         considered the same, regardless of when we find it.
+
+        The id is only computed the first time this is called, then cached on the JobPost.
         """
-        job_key = '{}_{}_{}'.format(
-            self.job_title, self.job_organization_name, self.location_search_term
-        )
-        return hashlib.md5(job_key.encode('utf-8')).hexdigest()
+        if self._job_id is None:
+            # Join with \x1f (the ASCII unit separator) rather than `_`, which does show up in real
+            # titles and names and could make two different jobs share a key
+            self._job_id = xxhash.xxh64_hexdigest(
+                f'{self.job_title}\x1f{self.job_organization_name}\x1f{self.location_search_term}'
+                .encode('utf-8')
+            )
 
-    def to_dict_with_id(self):
-        as_dict = self._asdict()
-        as_dict['job_id'] = self.generate_job_id()
+        return self._job_id
 
-        return as_dict
+    @property
+    def job_id(self):
+        return self.generate_job_id()
 
 def write_csv(dataset, csv_path, column_names):
     """
@@ -97,23 +126,24 @@ def write_csv(dataset, csv_path, column_names):
     csv_path - path to save data to
     column_names - the names of the columns for the CSV, in the desired order of columns in the CSV
     """
+    # Every column is an attribute of JobPost (including `job_id`), so each row is just those
+    # attributes in column order
     with open(csv_path, 'w') as f:
-        writer = csv.DictWriter(f, column_names)
-        writer.writeheader()
-        for row in dataset:
-            writer.writerow(row.to_dict_with_id())
+        writer = csv.writer(f)
+        writer.writerow(column_names)
+        writer.writerows(map(operator.attrgetter(*column_names), dataset))
 
 def process_block(block, source_url, job_search_term, location_search_term):
-    job_title = block.find('span', {'class': 'just_job_title'}).text
-
-    job_org_link = block.find('a', {'class': 't_org_link'})
-    job_org_name = job_org_link.text
+    """
+    block - a dict of the fields of one job card, as returned by EXTRACT_JOB_FIELDS_JS
+    """
+    job_title = block['title']
+    job_org_name = block['org']
 
-    snippet = block.find('p', {'class': 'job_snippet'})
     # Strip leading and trailing whitespace
-    snippet_text = snippet.text.encode('ascii', 'ignore').lstrip().rstrip()
+    snippet_text = block['snippet'].encode('ascii', 'ignore').lstrip().rstrip()
 
-    full_job_url = block.find('a', {'class': 'job_link'}).attrs['href']
+    full_job_url = block['href']
 
     job_post = JobPost(
         job_title,
@@ -127,15 +157,6 @@ def process_block(block, source_url, job_search_term, location_search_term):
 
     return job_post
 
-def dedupe_jobs(list_of_jobs):
-    id_to_job = {}
-    for job in list_of_jobs:
-        job_id = job.generate_job_id()
-        if job_id not in id_to_job:
-            id_to_job[job_id] = job
-
-    return id_to_job.values()
-
 class ContentBlockExtractor:
     def __init__(self, driver, url):
         self.driver = driver
@@ -145,10 +166,22 @@ class ContentBlockExtractor:
         return len(self._get_jobs_on_page())
 
     def _get_jobs_on_page(self):
-        return self.driver.find_elements_by_css_selector('div.job_content')
+        return self.driver.find_elements(By.CSS_SELECTOR, 'div.job_content')
+
+    def _wait_for_more_jobs(self, num_jobs_seen, timeout_seconds=3):
+        """
+        Wait until more than `num_jobs_seen` jobs are on the page, or until `timeout_seconds` have
+        passed, whichever comes first
+        """
+        try:
+            WebDriverWait(self.driver, timeout_seconds, poll_frequency=0.1).until(
+                lambda _: self._get_num_jobs_shown() > num_jobs_seen
+            )
+        except TimeoutException:
+            pass
 
     def _scroll_to_bottom(self):
-        driver.execute_script('window.scrollTo(0,document.body.scrollHeight)')
+        self.driver.execute_script('window.scrollTo(0,document.body.scrollHeight)')
 
     def _scroll_to_element(self, element):
         # idk https://stackoverflow.com/a/41744403
@@ -164,6 +197,9 @@ class ContentBlockExtractor:
     def get_all_blocks(self):
         logger.info('Getting {}'.format(self.url))
         self.driver.get(self.url)
+        # With the 'eager' page load strategy `get` returns before the job cards are necessarily
+        # rendered, so give the first ones a chance to show up before deciding there are none
+        self._wait_for_more_jobs(0, timeout_seconds=10)
         current_jobs = []
         while True:
             last_seen_jobs = self._get_jobs_on_page()
@@ -176,8 +212,8 @@ class ContentBlockExtractor:
 
             # the "scroll'n'sleep"
             self._scroll_a_little_past_element(last_seen_jobs[-1])
-            # Wait a few seconds for new jobs to appear
-            time.sleep(2)
+            # Wait (up to a few seconds) for new jobs to appear
+            self._wait_for_more_jobs(len(last_seen_jobs))
 
             # Check for more jobs! If we find more, then continue. Otherwise we'll try looking for
             # the "load more jobs" button
@@ -189,11 +225,11 @@ class ContentBlockExtractor:
 
             # Look for and click the "load more jobs" button
             try:
-                WebDriverWait(driver, 5).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "button.load_more_jobs"))).click()
+                WebDriverWait(self.driver, 5).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "button.load_more_jobs"))).click()
             except Exception as e:
                 logger.info('Load more jobs button did not appear. Exception: {}'.format(str(e)))
 
-            time.sleep(3)
+            self._wait_for_more_jobs(len(last_seen_jobs))
             current_jobs = self._get_jobs_on_page()
             logger.info('Now have {} jobs after scrolling'.format(len(current_jobs)))
             if len(current_jobs) == len(last_seen_jobs):
@@ -204,12 +240,11 @@ class ContentBlockExtractor:
                 last_seen_jobs = current_jobs
 
         logger.info('Found {} jobs'.format(len(current_jobs)))
-        soup = BeautifulSoup(self.driver.page_source, 'html.parser')
+        # Extract the fields from the job cards right in the browser, rather than pulling down and
+        # re-parsing the whole page source
+        job_fields = self.driver.execute_script(EXTRACT_JOB_FIELDS_JS, self._get_jobs_on_page())
 
-        jobs_from_bs = soup.findAll('div', {'class': 'job_content'})
-        logger.info('Found {} using selenium, {} using BS'.format(len(current_jobs), len(jobs_from_bs)))
-
-        return jobs_from_bs
+        return job_fields
 
 
 def process_search(driver):
@@ -219,7 +254,9 @@ def process_search(driver):
         time_started.minute
     )
     logger.info('Will write output to {}'.format(outfile_name))
+    # deduped as we go
     all_jobs = []
+    seen_ids = set()
 
     for location in LOCATIONS_TO_SEARCH:
         for search_term in SEARCH_KEYWORDS:
@@ -230,18 +267,37 @@ def process_search(driver):
             # Now that we have them all, parse out their contents
             for block in content_blocks:
                 one_job = process_block(block, url, search_term, location)
+                job_id = one_job.generate_job_id()
+                if job_id in seen_ids:
+                    continue
+                seen_ids.add(job_id)
                 all_jobs.append(one_job)
 
             logger.info('Sleeping {} second(s)'.format(SLEEP_TIME_SECONDS))
             time.sleep(SLEEP_TIME_SECONDS)
 
-    logger.info('Length of all_jobs {}'.format(len(all_jobs)))
-    deduped = dedupe_jobs(all_jobs)
-    logger.info('Length of deduped {}'.format(len(deduped)))
-    write_csv(deduped, outfile_name, JOB_POST_FIELD_NAMES_WITH_ID)
+    logger.info('Length of deduped all_jobs {}'.format(len(all_jobs)))
+    write_csv(all_jobs, outfile_name, JOB_POST_FIELD_NAMES_WITH_ID)
+
+def build_chrome_options():
+    """
+    We only need the text of the job cards, so skip images and stylesheets (and don't bother with
+    a window at all). `driver.get` also returns once the DOM is ready rather than waiting for every
+    last resource to load.
+    """
+    options = webdriver.ChromeOptions()
+    options.add_argument('--headless=new')
+    options.add_argument('--blink-settings=imagesEnabled=false')
+    options.add_experimental_option('prefs', {
+        'profile.managed_default_content_settings.images': 2,
+        'profile.managed_default_content_settings.stylesheets': 2,
+    })
+    options.page_load_strategy = 'eager'
+
+    return options
 
 if __name__ == '__main__':
-    driver = webdriver.Chrome('/Users/nick/Downloads/chromedriver')
+    driver = webdriver.Chrome('/Users/nick/Downloads/chromedriver', options=build_chrome_options())
     try:
         process_search(driver)
     finally: